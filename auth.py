@@ -1,5 +1,7 @@
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta, UTC
-from typing import Optional
+from typing import Optional, Dict, Tuple
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
@@ -9,7 +11,10 @@ from pydantic import BaseModel, ConfigDict
 # 配置
 SECRET_KEY = "your-secret-key-here"  # 在生产环境中应该使用环境变量
 ALGORITHM = "HS256"
+JWT_ALGORITHMS = [ALGORITHM]  # 预先构造，避免每次解码时重建列表
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+USER_CACHE_TTL = 60.0  # 用户信息缓存有效期（秒）
+TOKEN_CACHE_SIZE = 4096  # 令牌解码缓存的最大条目数
 
 # 密码加密上下文
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -33,10 +38,6 @@ class Token(BaseModel):
     access_token: str
     token_type: str
 
-class TokenData(BaseModel):
-    model_config = ConfigDict(from_attributes=True)
-    username: Optional[str] = None
-
 # 模拟用户数据库
 fake_users_db = {
     "test_user": {
@@ -56,16 +57,45 @@ def get_password_hash(password: str) -> str:
     """获取密码哈希值"""
     return pwd_context.hash(password)
 
+def load_user(username: str) -> Optional[UserInDB]:
+    """从用户库读取用户信息（不经过缓存）"""
+    user_dict = fake_users_db.get(username)
+    if user_dict is None:
+        return None
+    return UserInDB(**user_dict)
+
+# 用户信息缓存：username -> (用户, 缓存时间)
+_user_cache: Dict[str, Tuple[UserInDB, float]] = {}
+
 def get_user(username: str) -> Optional[UserInDB]:
-    """获取用户信息"""
-    if username in fake_users_db:
-        user_dict = fake_users_db[username]
-        return UserInDB(**user_dict)
-    return None
+    """
+    获取用户信息（带 TTL 缓存，用于已认证请求的热路径）
+    
+    用户数据修改后最多 USER_CACHE_TTL 秒才生效，需要立即生效时调用 invalidate_user。
+    """
+    now = time.monotonic()
+    hit = _user_cache.get(username)
+    if hit is not None and now - hit[1] < USER_CACHE_TTL:
+        return hit[0]
+    user = load_user(username)
+    if user is None:
+        _user_cache.pop(username, None)
+        return None
+    _user_cache[username] = (user, now)
+    return user
+
+def invalidate_user(username: str) -> None:
+    """使用户缓存失效（用户被禁用或修改后调用）"""
+    _user_cache.pop(username, None)
+
+def reload_auth_caches() -> None:
+    """清空用户和令牌缓存（用户数据整体变更后调用）"""
+    _user_cache.clear()
+    _token_cache.clear()
 
 def authenticate_user(username: str, password: str) -> Optional[UserInDB]:
-    """验证用户"""
-    user = get_user(username)
+    """验证用户（直接读取用户库，密码修改后立即生效）"""
+    user = load_user(username)
     if not user:
         return None
     if not verify_password(password, user.hashed_password):
@@ -83,24 +113,45 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
-    """获取当前用户"""
-    credentials_exception = HTTPException(
+def credentials_exception() -> HTTPException:
+    """构造认证失败异常（仅在失败路径上创建）"""
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="无效的认证凭据",
         headers={"WWW-Authenticate": "Bearer"},
     )
+
+# 令牌解码缓存（LRU）：token -> (用户名, 过期时间戳)
+_token_cache: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+def decode_token_subject(token: str) -> Optional[str]:
+    """解码令牌并返回用户名，结果缓存至令牌过期，避免重复验签"""
+    hit = _token_cache.get(token)
+    if hit is not None:
+        if time.time() < hit[1]:
+            _token_cache.move_to_end(token)
+            return hit[0]
+        del _token_cache[token]
+    payload = jwt.decode(token, SECRET_KEY, algorithms=JWT_ALGORITHMS)
+    username = payload.get("sub")
+    exp = payload.get("exp")
+    if username is not None and exp is not None:
+        _token_cache[token] = (username, float(exp))
+        if len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return username
+
+async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
+    """获取当前用户"""
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
+        username = decode_token_subject(token)
     except JWTError:
-        raise credentials_exception
-    user = get_user(username=token_data.username)
+        raise credentials_exception()
+    if username is None:
+        raise credentials_exception()
+    user = get_user(username)
     if user is None:
-        raise credentials_exception
+        raise credentials_exception()
     return user
 
 async def get_current_active_user(current_user: User = Depends(get_current_user)) -> User:
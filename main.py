@@ -1,9 +1,11 @@
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Request, Response, status
 from fastapi.security import OAuth2PasswordRequestForm
 import httpx
+import orjson
 import logging
 import os
-from typing import Optional, Dict
+from contextlib import asynccontextmanager
+from typing import Optional, Dict, Union
 from pydantic import BaseModel, ConfigDict
 from datetime import timedelta
 from auth import (
@@ -11,39 +13,101 @@ from auth import (
     get_current_active_user, ACCESS_TOKEN_EXPIRE_MINUTES
 )
 
+class JsonFormatter(logging.Formatter):
+    """结构化 JSON 日志格式，附加字段通过 extra={"extra_fields": {...}} 传入"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        # 先合并附加字段，再写入保留字段，避免调用方覆盖 ts/lvl/logger/msg
+        data = dict(getattr(record, "extra_fields", None) or {})
+        data.update(
+            ts=record.created,
+            lvl=record.levelname,
+            logger=record.name,
+            msg=record.getMessage(),
+        )
+        if record.exc_info:
+            data["exc"] = self.formatException(record.exc_info)
+        return orjson.dumps(data, default=str).decode()
+
 # 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.StreamHandler()]
-)
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(JsonFormatter())
+logging.basicConfig(level=logging.INFO, handlers=[log_handler])
 logger = logging.getLogger(__name__)
 
+# 模拟公共 AI API 地址
+PUBLIC_AI_API_URL = os.getenv("PUBLIC_AI_API_URL", "https://api.example.com/scan")
+# 上游仅支持 HTTP/1.1 时设置为 false，避免协议协商回退的开销
+AI_API_HTTP2 = os.getenv("AI_API_HTTP2", "true").lower() == "true"
+# 启动时预先建立到上游的连接，避免首个请求承担建连开销（需先配置 PUBLIC_AI_API_URL）
+AI_API_PREWARM = os.getenv("AI_API_PREWARM", "false").lower() == "true"
+# 预热请求的超时（秒），避免上游缓慢时拖慢每个 worker 的启动
+AI_API_PREWARM_TIMEOUT = 2.0
+# 生产环境可设置为 false，关闭 /docs、/redoc 和 OpenAPI schema 生成
+ENABLE_DOCS = os.getenv("ENABLE_DOCS", "true").lower() == "true"
+# 日志中请求内容预览的最大长度
+LOG_PREVIEW_LENGTH = 100
+
+def create_http_client() -> httpx.AsyncClient:
+    """创建调用 AI API 的共享 HTTP 客户端（HTTP/2 多路复用 + 连接池）"""
+    transport = httpx.AsyncHTTPTransport(
+        http2=AI_API_HTTP2,
+        limits=httpx.Limits(
+            max_connections=500,
+            max_keepalive_connections=100,
+            keepalive_expiry=30.0
+        ),
+        retries=1
+    )
+    return httpx.AsyncClient(
+        transport=transport,
+        timeout=httpx.Timeout(connect=5.0, read=30.0, write=10.0, pool=5.0)
+    )
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期：创建并复用共享的 HTTP 客户端（连接池 / keep-alive）"""
+    app.state.http_client = create_http_client()
+    try:
+        if AI_API_PREWARM:
+            try:
+                await app.state.http_client.head(
+                    PUBLIC_AI_API_URL, timeout=AI_API_PREWARM_TIMEOUT
+                )
+            except httpx.HTTPError as e:
+                logger.warning("ai_api_prewarm_failed", extra={"extra_fields": {"error": repr(e)}})
+        yield
+    finally:
+        await app.state.http_client.aclose()
+
 app = FastAPI(
     title="D-Mid Middleware",
     description="这是一个代码扫描中间件服务，用于连接用户和 AI 代码扫描服务。",
     version="1.0.0",
-    docs_url="/docs",
-    redoc_url="/redoc"
+    docs_url="/docs" if ENABLE_DOCS else None,
+    redoc_url="/redoc" if ENABLE_DOCS else None,
+    openapi_url="/openapi.json" if ENABLE_DOCS else None,
+    lifespan=lifespan
 )
 
-# 模拟公共 AI API 地址
-PUBLIC_AI_API_URL = os.getenv("PUBLIC_AI_API_URL", "https://api.example.com/scan")
+# 文档示例按需加载：只有生成 OpenAPI schema 时才导入 main_examples
+def scan_request_example(schema: Dict) -> None:
+    """为请求模型的 schema 添加示例"""
+    from main_examples import SCAN_REQUEST_EXAMPLE
+    schema["example"] = SCAN_REQUEST_EXAMPLE
+
+def scan_response_example(schema: Dict) -> None:
+    """为响应模型的 schema 添加示例"""
+    from main_examples import SCAN_RESPONSE_EXAMPLE
+    schema["example"] = SCAN_RESPONSE_EXAMPLE
 
 # 请求模型
 class ScanRequest(BaseModel):
     model_config = ConfigDict(
         from_attributes=True,
-        json_schema_extra={
-            "example": {
-                "code": "def hello_world():\n    print('Hello, World!')",
-                "language": "python",
-                "options": {
-                    "max_line_length": 80,
-                    "check_style": True
-                }
-            }
-        }
+        extra="ignore",
+        frozen=True,
+        json_schema_extra=scan_request_example
     )
     code: str
     language: str
@@ -53,27 +117,19 @@ class ScanRequest(BaseModel):
 class ScanResponse(BaseModel):
     model_config = ConfigDict(
         from_attributes=True,
-        json_schema_extra={
-            "example": {
-                "status": "success",
-                "result": {
-                    "issues": [],
-                    "score": 95,
-                    "suggestions": []
-                },
-                "user_id": "user1"
-            }
-        }
+        json_schema_extra=scan_response_example
     )
     status: str
     result: Dict
     user_id: str
 
-# 健康检查端点
-@app.get("/health")
+# 健康检查端点（预先序列化的响应体，负载均衡器高频探测时无需重复编码）
+HEALTH_BODY = b'{"status":"healthy"}'
+
+@app.get("/health", include_in_schema=False)
 async def health_check():
     """健康检查端点"""
-    return {"status": "healthy"}
+    return Response(content=HEALTH_BODY, media_type="application/json")
 
 # 认证端点
 @app.post("/token", response_model=Token)
@@ -92,17 +148,89 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
-# 代码扫描端点
-@app.post("/scan", response_model=ScanResponse)
+def make_log_preview(data: Union[str, bytes]) -> str:
+    """截取前 LOG_PREVIEW_LENGTH 个字符生成日志预览，不复制或转换其余数据"""
+    head = data[:LOG_PREVIEW_LENGTH]
+    if isinstance(head, bytes):
+        head = head.decode("utf-8", "replace")
+    if len(data) > LOG_PREVIEW_LENGTH:
+        head += "... (truncated)"
+    return head
+
+async def forward_scan(request: Request, username: str, **request_kwargs) -> Response:
+    """
+    将扫描请求转发到 AI API
+    
+    Args:
+        request: 原始请求，用于访问共享的 HTTP 客户端
+        username: 当前认证用户名
+        request_kwargs: 传给 httpx 的请求参数（content=、headers= 等）
+        
+    Returns:
+        Response: 扫描结果响应（结构同 ScanResponse，上游结果字节原样转发，不做响应校验）
+        
+    Raises:
+        HTTPException: 当扫描服务出错时
+    """
+    try:
+        client: httpx.AsyncClient = request.app.state.http_client
+        response = await client.post(PUBLIC_AI_API_URL, **request_kwargs)
+        response.raise_for_status()
+        # 完整解析一次上游返回，仅用于拒绝非法 JSON，解析结果直接丢弃；
+        # 响应中拼接的是上游的原始字节，不重新编码（超过 64 位的整数等数据不会失真）
+        orjson.loads(response.content)
+    except httpx.RequestError as e:
+        logger.error(
+            "ai_api_unavailable",
+            extra={"extra_fields": {"user_id": username, "error": str(e)}}
+        )
+        raise HTTPException(status_code=500, detail="AI service unavailable")
+    except httpx.HTTPStatusError as e:
+        logger.error(
+            "ai_api_error",
+            extra={"extra_fields": {"user_id": username, "status_code": e.response.status_code}}
+        )
+        raise HTTPException(status_code=e.response.status_code, detail="AI service error")
+    except orjson.JSONDecodeError as e:
+        logger.error(
+            "ai_api_invalid_response",
+            extra={"extra_fields": {"user_id": username, "error": str(e)}}
+        )
+        raise HTTPException(status_code=500, detail="AI service error")
+
+    logger.info("scan_completed", extra={"extra_fields": {"user_id": username}})
+    return Response(
+        content=(
+            b'{"status":"success","result":' + response.content
+            + b',"user_id":' + orjson.dumps(username) + b'}'
+        ),
+        media_type="application/json"
+    )
+
+# 代码扫描端点（直接转发原始请求体）
+@app.post(
+    "/scan",
+    response_model=None,
+    responses={200: {"model": ScanResponse}},
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {"application/json": {"schema": {"$ref": "#/components/schemas/ScanRequest"}}}
+        }
+    }
+)
 async def scan_code(
-    request_data: ScanRequest,
+    request: Request,
     current_user: User = Depends(get_current_active_user)
 ):
     """
     代码扫描端点
     
+    请求体不做解析和校验，原样转发给 AI API，避免 JSON 解析与重新编码的开销。
+    需要校验请求结构的客户端请使用 /scan/validated。
+    
     Args:
-        request_data: 包含代码和扫描选项的请求数据
+        request: 原始请求
         current_user: 当前认证用户
         
     Returns:
@@ -111,32 +239,83 @@ async def scan_code(
     Raises:
         HTTPException: 当扫描服务出错时
     """
-    # 优化日志显示，避免显示大量数据
-    log_data = request_data.model_dump()
-    if "code" in log_data and len(str(log_data["code"])) > 100:
-        log_data["code"] = f"{str(log_data['code'])[:100]}... (truncated)"
-    logger.info(f"User {current_user.username} sent scan request: {log_data}")
+    body = await request.body()
+    if logger.isEnabledFor(logging.DEBUG):
+        preview = make_log_preview(body)
+        logger.debug(
+            "scan_request",
+            extra={"extra_fields": {
+                "user_id": current_user.username,
+                "body_preview": preview,
+                "bytes": len(body)
+            }}
+        )
 
-    try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                PUBLIC_AI_API_URL,
-                json=request_data.model_dump(),
-                timeout=30.0
-            )
-            response.raise_for_status()
-            result = response.json()
-
-        logger.info(f"User {current_user.username} scan completed")
-        return {"status": "success", "result": result, "user_id": current_user.username}
+    return await forward_scan(
+        request,
+        current_user.username,
+        content=body,
+        headers={"Content-Type": "application/json"}
+    )
 
-    except httpx.RequestError as e:
-        logger.error(f"User {current_user.username} failed to call AI API: {str(e)}")
-        raise HTTPException(status_code=500, detail="AI service unavailable")
-    except httpx.HTTPStatusError as e:
-        logger.error(f"User {current_user.username} AI API error: {e.response.status_code}")
-        raise HTTPException(status_code=e.response.status_code, detail="AI service error")
+# 代码扫描端点（校验请求结构）
+@app.post(
+    "/scan/validated",
+    response_model=None,
+    responses={200: {"model": ScanResponse}}
+)
+async def scan_code_validated(
+    request: Request,
+    request_data: ScanRequest,
+    current_user: User = Depends(get_current_active_user)
+):
+    """
+    带请求校验的代码扫描端点
+    
+    Args:
+        request: 原始请求，用于访问共享的 HTTP 客户端
+        request_data: 包含代码和扫描选项的请求数据
+        current_user: 当前认证用户
+        
+    Returns:
+        ScanResponse: 扫描结果
+        
+    Raises:
+        HTTPException: 当扫描服务出错时
+    """
+    # 请求内容仅在 DEBUG 级别记录；直接截取 code 字段生成预览，不拷贝整个请求
+    if logger.isEnabledFor(logging.DEBUG):
+        preview = make_log_preview(request_data.code)
+        logger.debug(
+            "scan_request",
+            extra={"extra_fields": {
+                "user_id": current_user.username,
+                "code_preview": preview,
+                "lang": request_data.language
+            }}
+        )
+
+    # model_dump_json 直接在 pydantic-core 中序列化，省去 dict 构建和 httpx 的 JSON 编码
+    return await forward_scan(
+        request,
+        current_user.username,
+        content=request_data.model_dump_json(),
+        headers={"Content-Type": "application/json"}
+    )
 
 if __name__ == "__main__":
+    # 多进程部署也可使用：gunicorn -k uvicorn.workers.UvicornWorker -w N main:app
+    # 生产镜像建议设置 PYTHONDONTWRITEBYTECODE=1 并以 python -O 启动；
+    # 不要使用 -OO，它会去掉 docstring，而 OpenAPI 文档的接口说明依赖 docstring
+    # uvicorn 仅在直接运行时需要，放在这里导入，worker 进程导入 main 时不会加载它
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="httptools",
+        access_log=False,
+        proxy_headers=False,
+        workers=os.cpu_count()
+    )
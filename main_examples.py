@@ -0,0 +1,26 @@
+"""
+OpenAPI 文档示例数据
+
+仅在生成 OpenAPI schema 时按需导入，不参与请求处理。
+"""
+
+# 扫描请求示例
+SCAN_REQUEST_EXAMPLE = {
+    "code": "def hello_world():\n    print('Hello, World!')",
+    "language": "python",
+    "options": {
+        "max_line_length": 80,
+        "check_style": True
+    }
+}
+
+# 扫描响应示例
+SCAN_RESPONSE_EXAMPLE = {
+    "status": "success",
+    "result": {
+        "issues": [],
+        "score": 95,
+        "suggestions": []
+    },
+    "user_id": "user1"
+}
@@ -0,0 +1,55 @@
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+import main
+from main import app
+from auth import reload_auth_caches
+
+class MockUpstream:
+    """模拟 AI API：记录转发的请求，测试可替换响应处理函数"""
+
+    # 默认返回的扫描结果
+    default_response = {"result": "test result"}
+
+    def __init__(self):
+        self.requests = []
+        self.reset()
+
+    def default_handler(self, request: httpx.Request) -> httpx.Response:
+        """默认返回成功的扫描结果"""
+        return httpx.Response(200, json=self.default_response)
+
+    def reset(self):
+        """恢复默认处理函数并清空请求记录"""
+        self.handler = self.default_handler
+        self.requests.clear()
+
+    def dispatch(self, request: httpx.Request) -> httpx.Response:
+        """只匹配 POST 到 AI API 地址的请求，记录后交给当前的处理函数"""
+        if request.method != "POST" or str(request.url) != main.PUBLIC_AI_API_URL:
+            raise AssertionError(f"Unexpected upstream request: {request.method} {request.url}")
+        self.requests.append(request)
+        return self.handler(request)
+
+@pytest.fixture(scope="session")
+def mock_upstream():
+    """整个测试会话共享的 AI API 模拟"""
+    return MockUpstream()
+
+@pytest.fixture(scope="session")
+def client(mock_upstream):
+    """会话级测试客户端，应用 lifespan 只启动一次"""
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(mock_upstream.dispatch))
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(main, "create_http_client", lambda: http_client)
+        # 测试中不预热连接（模拟的 AI API 只接受 POST 扫描请求）
+        mp.setattr(main, "AI_API_PREWARM", False)
+        with TestClient(app) as test_client:
+            yield test_client
+
+@pytest.fixture(autouse=True)
+def upstream(mock_upstream):
+    """每个测试前恢复默认的 AI API 模拟并清空认证缓存"""
+    mock_upstream.reset()
+    reload_auth_caches()
+    yield mock_upstream
@@ -1,24 +1,25 @@
 import pytest
-from fastapi.testclient import TestClient
-from main import app
-import os
-from unittest.mock import patch, MagicMock
 import asyncio
+import json
+import os
 from fastapi import HTTPException
 import httpx
 import logging
-from auth import create_access_token
+import time
+from datetime import timedelta
+from types import SimpleNamespace
+import main
+from main import JsonFormatter, make_log_preview
+import auth
+from jose import ExpiredSignatureError, JWTError
+from auth import create_access_token, fake_users_db, invalidate_user
 
 # 配置测试日志
 logger = logging.getLogger(__name__)
 
-# 创建测试客户端
-client = TestClient(app)
-
 # 测试数据
 TEST_USERNAME = "test_user"
 TEST_PASSWORD = "test123"
-TEST_RESPONSE = {"result": "test result"}
 
 # 获取测试令牌
 def get_test_token():
@@ -37,7 +38,7 @@ def setup_env():
         del os.environ["TESTING"]
 
 # 基础功能测试
-def test_health_check():
+def test_health_check(client):
     """测试健康检查端点"""
     logger.info("Testing health check endpoint")
     response = client.get("/health")
@@ -45,8 +46,58 @@ def test_health_check():
     assert response.status_code == 200
     assert response.json() == {"status": "healthy"}
 
+def test_openapi_examples(client):
+    """测试 OpenAPI 文档包含按需加载的示例"""
+    logger.info("Testing OpenAPI examples")
+    response = client.get("/openapi.json")
+    assert response.status_code == 200
+    schemas = response.json()["components"]["schemas"]
+    assert schemas["ScanRequest"]["example"]["language"] == "python"
+    assert schemas["ScanResponse"]["example"]["status"] == "success"
+
+@pytest.mark.asyncio(scope="session")
+async def test_prewarm_failure_does_not_block_startup(monkeypatch):
+    """测试预热失败时应用仍能启动，并在退出时关闭 HTTP 客户端"""
+    logger.info("Testing AI API prewarm failure")
+
+    def unreachable(request):
+        raise httpx.ConnectError("unreachable", request=request)
+
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(unreachable))
+    monkeypatch.setattr(main, "AI_API_PREWARM", True)
+    monkeypatch.setattr(main, "create_http_client", lambda: http_client)
+    # lifespan 会替换 app.state.http_client，测试结束后恢复会话客户端的状态
+    monkeypatch.setattr(main.app.state, "http_client", None, raising=False)
+    async with main.app.router.lifespan_context(main.app):
+        assert not http_client.is_closed
+    assert http_client.is_closed
+
+def test_json_formatter():
+    """测试结构化 JSON 日志格式"""
+    record = logging.LogRecord("main", logging.INFO, __file__, 1, "scan_completed", None, None)
+    record.extra_fields = {"user_id": TEST_USERNAME}
+    data = json.loads(JsonFormatter().format(record))
+    assert data["lvl"] == "INFO"
+    assert data["msg"] == "scan_completed"
+    assert data["user_id"] == TEST_USERNAME
+
+def test_json_formatter_keeps_reserved_fields():
+    """测试附加字段不能覆盖保留字段"""
+    record = logging.LogRecord("main", logging.INFO, __file__, 1, "scan_completed", None, None)
+    record.extra_fields = {"msg": "spoofed", "lvl": "DEBUG", "user_id": TEST_USERNAME}
+    data = json.loads(JsonFormatter().format(record))
+    assert data["msg"] == "scan_completed"
+    assert data["lvl"] == "INFO"
+    assert data["user_id"] == TEST_USERNAME
+
+def test_make_log_preview():
+    """测试日志预览只保留前 100 个字符"""
+    assert make_log_preview("short") == "short"
+    assert make_log_preview("x" * 1000000) == "x" * 100 + "... (truncated)"
+    assert make_log_preview("你好".encode() * 100).endswith("... (truncated)")
+
 # 认证测试
-def test_login_success():
+def test_login_success(client):
     """测试登录成功"""
     logger.info("Testing successful login")
     response = client.post(
@@ -61,7 +112,7 @@ def test_login_success():
     assert "access_token" in response.json()
     assert response.json()["token_type"] == "bearer"
 
-def test_login_failure():
+def test_login_failure(client):
     """测试登录失败"""
     logger.info("Testing failed login")
     response = client.post(
@@ -75,8 +126,114 @@ def test_login_failure():
     assert response.status_code == 401
     assert response.json()["detail"] == "用户名或密码错误"
 
+def test_disabled_user_after_cache_invalidation(client):
+    """测试用户缓存失效后禁用状态立即生效"""
+    logger.info("Testing user cache invalidation")
+    token = get_test_token()
+    fake_users_db[TEST_USERNAME]["disabled"] = True
+    invalidate_user(TEST_USERNAME)
+    try:
+        response = client.post(
+            "/scan",
+            json={
+                "code": "test code",
+                "language": "python"
+            },
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        logger.debug(f"Response status: {response.status_code}")
+        assert response.status_code == 400
+        assert response.json()["detail"] == "用户已禁用"
+    finally:
+        fake_users_db[TEST_USERNAME]["disabled"] = False
+        invalidate_user(TEST_USERNAME)
+
+def test_login_uses_current_password(client, monkeypatch):
+    """测试登录不使用缓存的用户信息，修改密码后立即生效"""
+    logger.info("Testing login after password change")
+    assert auth.get_user(TEST_USERNAME) is not None  # 填充用户缓存
+    monkeypatch.setitem(
+        fake_users_db[TEST_USERNAME], "hashed_password", auth.get_password_hash("new_password")
+    )
+    response = client.post(
+        "/token",
+        data={
+            "username": TEST_USERNAME,
+            "password": TEST_PASSWORD
+        }
+    )
+    logger.debug(f"Login response: {response.json()}")
+    assert response.status_code == 401
+
+def test_user_cache_ttl(monkeypatch):
+    """测试用户缓存在 TTL 内返回旧值，过期后重新读取"""
+    logger.info("Testing user cache TTL")
+    now = [1000.0]
+    monkeypatch.setattr(auth, "time", SimpleNamespace(monotonic=lambda: now[0], time=time.time))
+    assert auth.get_user(TEST_USERNAME).full_name == "Test User"
+
+    monkeypatch.setitem(fake_users_db[TEST_USERNAME], "full_name", "Renamed User")
+    now[0] += auth.USER_CACHE_TTL - 1
+    assert auth.get_user(TEST_USERNAME).full_name == "Test User"
+
+    now[0] += 2
+    assert auth.get_user(TEST_USERNAME).full_name == "Renamed User"
+
+def test_user_cache_drops_deleted_user(monkeypatch):
+    """测试用户被删除后缓存过期时返回 None 并移除缓存"""
+    logger.info("Testing user cache for deleted user")
+    now = [1000.0]
+    monkeypatch.setattr(auth, "time", SimpleNamespace(monotonic=lambda: now[0], time=time.time))
+    assert auth.get_user(TEST_USERNAME) is not None
+
+    monkeypatch.delitem(fake_users_db, TEST_USERNAME)
+    now[0] += auth.USER_CACHE_TTL + 1
+    assert auth.get_user(TEST_USERNAME) is None
+    assert TEST_USERNAME not in auth._user_cache
+
+def test_token_cache_skips_verification(monkeypatch):
+    """测试同一令牌第二次解码走缓存，不再验签"""
+    logger.info("Testing token cache hit")
+    token = get_test_token()
+    assert auth.decode_token_subject(token) == TEST_USERNAME
+
+    def fail_decode(*args, **kwargs):
+        raise AssertionError("jwt.decode should not be called for a cached token")
+
+    monkeypatch.setattr(auth.jwt, "decode", fail_decode)
+    assert auth.decode_token_subject(token) == TEST_USERNAME
+
+def test_token_cache_drops_expired_entry(monkeypatch):
+    """测试缓存的令牌过期后被移除并重新验签（验签时被拒绝）"""
+    logger.info("Testing token cache expiry")
+    token = get_test_token()
+    assert auth.decode_token_subject(token) == TEST_USERNAME
+    exp = auth._token_cache[token][1]
+
+    monkeypatch.setattr(auth, "time", SimpleNamespace(monotonic=time.monotonic, time=lambda: exp + 1))
+
+    # jose 使用自己的时钟判断过期，这里模拟它在同一时刻会抛出的异常
+    def expired_decode(*args, **kwargs):
+        raise ExpiredSignatureError("Signature has expired.")
+
+    monkeypatch.setattr(auth.jwt, "decode", expired_decode)
+    with pytest.raises(JWTError):
+        auth.decode_token_subject(token)
+    assert token not in auth._token_cache
+
+def test_token_cache_evicts_oldest(monkeypatch):
+    """测试令牌缓存超过容量时淘汰最久未使用的条目"""
+    logger.info("Testing token cache eviction")
+    monkeypatch.setattr(auth, "TOKEN_CACHE_SIZE", 2)
+    tokens = [create_access_token({"sub": TEST_USERNAME, "n": i}) for i in range(3)]
+    auth.decode_token_subject(tokens[0])
+    auth.decode_token_subject(tokens[1])
+    auth.decode_token_subject(tokens[0])  # 访问后 tokens[0] 变为最近使用
+    auth.decode_token_subject(tokens[2])
+    assert list(auth._token_cache) == [tokens[0], tokens[2]]
+
 # API 访问测试
-def test_scan_code_without_token():
+def test_scan_code_without_token(client, upstream):
     """测试不带令牌的扫描请求"""
     logger.info("Testing scan request without token")
     response = client.post(
@@ -88,152 +245,229 @@ def test_scan_code_without_token():
     )
     logger.debug(f"Response status: {response.status_code}")
     assert response.status_code == 401
+    assert upstream.requests == []
+
+def test_scan_code_with_invalid_token(client, upstream):
+    """测试使用无效的令牌"""
+    logger.info("Testing scan request with invalid token")
+    response = client.post(
+        "/scan",
+        json={
+            "code": "def hello():\n    print('Hello')",
+            "language": "python"
+        },
+        headers={"Authorization": "Bearer invalid-token"}
+    )
+    logger.debug(f"Response status: {response.status_code}")
+    assert response.status_code == 401
+    assert response.json()["detail"] == "无效的认证凭据"
+    assert upstream.requests == []
 
-def test_scan_code_with_valid_token():
+def test_scan_code_with_expired_token(client, upstream):
+    """测试使用过期的令牌"""
+    logger.info("Testing scan request with expired token")
+    token = create_access_token({"sub": TEST_USERNAME}, timedelta(seconds=-1))
+    response = client.post(
+        "/scan",
+        json={
+            "code": "def hello():\n    print('Hello')",
+            "language": "python"
+        },
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    logger.debug(f"Response status: {response.status_code}")
+    assert response.status_code == 401
+    assert upstream.requests == []
+
+def test_scan_code_with_valid_token(client, upstream):
     """测试使用有效的令牌"""
     logger.info("Testing scan request with valid token")
     token = get_test_token()
-    with patch("httpx.AsyncClient.post") as mock_post:
-        mock_post.return_value = MagicMock(
-            status_code=200,
-            json=lambda: TEST_RESPONSE,
-            raise_for_status=lambda: None
-        )
-        
-        response = client.post(
-            "/scan",
-            json={
-                "code": "def hello():\n    print('Hello')",
-                "language": "python"
-            },
-            headers={"Authorization": f"Bearer {token}"}
-        )
-        logger.debug(f"Response: {response.json()}")
-        assert response.status_code == 200
-        data = response.json()
-        assert data["status"] == "success"
-        assert "result" in data
-        assert data["user_id"] == TEST_USERNAME
+    response = client.post(
+        "/scan",
+        json={
+            "code": "def hello():\n    print('Hello')",
+            "language": "python"
+        },
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    logger.debug(f"Response: {response.json()}")
+    assert response.status_code == 200
+    data = response.json()
+    assert data["status"] == "success"
+    assert data["result"] == upstream.default_response
+    assert data["user_id"] == TEST_USERNAME
+    assert upstream.requests[0].headers["Content-Type"] == "application/json"
+
+def test_scan_with_large_integer_result(client, upstream):
+    """测试 AI API 返回的超大整数原样保留"""
+    logger.info("Testing scan response with large integer")
+    token = get_test_token()
+    upstream.handler = lambda request: httpx.Response(
+        200,
+        content=b'{"n": 123456789012345678901234567890}',
+        headers={"Content-Type": "application/json"}
+    )
+    response = client.post(
+        "/scan",
+        json={
+            "code": "test code",
+            "language": "python"
+        },
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    logger.debug(f"Response status: {response.status_code}")
+    assert response.status_code == 200
+    assert b"123456789012345678901234567890" in response.content
+    assert json.loads(response.content)["result"]["n"] == 123456789012345678901234567890
+
+def test_scan_validated_with_valid_token(client, upstream):
+    """测试带校验的扫描端点"""
+    logger.info("Testing validated scan request with valid token")
+    token = get_test_token()
+    response = client.post(
+        "/scan/validated",
+        json={
+            "code": "def hello():\n    print('Hello')",
+            "language": "python"
+        },
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    logger.debug(f"Response: {response.json()}")
+    assert response.status_code == 200
+    assert response.json()["user_id"] == TEST_USERNAME
+    assert json.loads(upstream.requests[0].content)["language"] == "python"
+
+def test_scan_validated_with_invalid_data(client):
+    """测试带校验的扫描端点拒绝缺少字段的请求"""
+    logger.info("Testing validated scan request with invalid data")
+    token = get_test_token()
+    response = client.post(
+        "/scan/validated",
+        json={"code": "test code"},
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    logger.debug(f"Response status: {response.status_code}")
+    assert response.status_code == 422
 
 # 请求数据测试
-def test_scan_with_empty_data():
+def test_scan_with_empty_data(client):
     """测试空数据请求"""
     logger.info("Testing scan request with empty data")
     token = get_test_token()
-    with patch("httpx.AsyncClient.post") as mock_post:
-        mock_post.return_value = MagicMock(
-            status_code=200,
-            json=lambda: TEST_RESPONSE,
-            raise_for_status=lambda: None
-        )
-        
-        response = client.post(
-            "/scan",
-            json={
-                "code": "",
-                "language": "python"
-            },
-            headers={"Authorization": f"Bearer {token}"}
-        )
-        logger.debug(f"Response status: {response.status_code}")
-        assert response.status_code == 200
+    response = client.post(
+        "/scan",
+        json={
+            "code": "",
+            "language": "python"
+        },
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    logger.debug(f"Response status: {response.status_code}")
+    assert response.status_code == 200
 
-def test_scan_with_large_data():
+def test_scan_with_large_data(client, upstream):
     """测试大数据请求"""
     logger.info("Testing scan request with large data")
     token = get_test_token()
-    with patch("httpx.AsyncClient.post") as mock_post:
-        mock_post.return_value = MagicMock(
-            status_code=200,
-            json=lambda: TEST_RESPONSE,
-            raise_for_status=lambda: None
-        )
-        
-        response = client.post(
-            "/scan",
-            json={
-                "code": "x" * 1000000,  # 1MB 数据
-                "language": "python"
-            },
-            headers={"Authorization": f"Bearer {token}"}
-        )
-        logger.debug(f"Response status: {response.status_code}")
-        assert response.status_code == 200
+    response = client.post(
+        "/scan",
+        json={
+            "code": "x" * 1000000,  # 1MB 数据
+            "language": "python"
+        },
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    logger.debug(f"Response status: {response.status_code}")
+    assert response.status_code == 200
+    assert len(upstream.requests[0].content) > 1000000
 
 # 错误处理测试
-def test_scan_with_network_error():
+def test_scan_with_network_error(client, upstream):
     """测试网络错误"""
     logger.info("Testing scan request with network error")
     token = get_test_token()
-    with patch("httpx.AsyncClient.post") as mock_post:
-        mock_post.side_effect = httpx.RequestError("Network error")
-        
-        response = client.post(
-            "/scan",
-            json={
-                "code": "test code",
-                "language": "python"
-            },
-            headers={"Authorization": f"Bearer {token}"}
-        )
-        logger.debug(f"Response status: {response.status_code}")
-        assert response.status_code == 500
-        assert response.json()["detail"] == "AI service unavailable"
 
-def test_scan_with_http_error():
+    def network_error(request):
+        raise httpx.ConnectError("Network error", request=request)
+
+    upstream.handler = network_error
+    response = client.post(
+        "/scan",
+        json={
+            "code": "test code",
+            "language": "python"
+        },
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    logger.debug(f"Response status: {response.status_code}")
+    assert response.status_code == 500
+    assert response.json()["detail"] == "AI service unavailable"
+
+def test_scan_with_invalid_json_result(client, upstream):
+    """测试 AI API 返回非法 JSON"""
+    logger.info("Testing scan request with invalid upstream JSON")
+    token = get_test_token()
+    upstream.handler = lambda request: httpx.Response(200, content=b"not json")
+    response = client.post(
+        "/scan",
+        json={
+            "code": "test code",
+            "language": "python"
+        },
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    logger.debug(f"Response status: {response.status_code}")
+    assert response.status_code == 500
+    assert response.json()["detail"] == "AI service error"
+
+def test_scan_with_http_error(client, upstream):
     """测试 HTTP 错误"""
     logger.info("Testing scan request with HTTP error")
     token = get_test_token()
-    with patch("httpx.AsyncClient.post") as mock_post:
-        # 创建一个模拟的响应对象
-        mock_response = MagicMock()
-        mock_response.status_code = 500  # 设置具体的状态码
-        mock_response.raise_for_status.side_effect = httpx.HTTPStatusError(
-            "HTTP error", request=MagicMock(), response=mock_response
-        )
-        mock_post.return_value = mock_response
-        
-        response = client.post(
-            "/scan",
-            json={
-                "code": "test code",
-                "language": "python"
-            },
-            headers={"Authorization": f"Bearer {token}"}
-        )
-        logger.debug(f"Response status: {response.status_code}")
-        assert response.status_code == 500
-        assert response.json()["detail"] == "AI service error"
+    upstream.handler = lambda request: httpx.Response(500)
+    response = client.post(
+        "/scan",
+        json={
+            "code": "test code",
+            "language": "python"
+        },
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    logger.debug(f"Response status: {response.status_code}")
+    assert response.status_code == 500
+    assert response.json()["detail"] == "AI service error"
 
 # 超时测试
-@pytest.mark.asyncio
-async def test_scan_timeout():
+def test_scan_timeout(client, upstream):
     """测试请求超时"""
     logger.info("Testing scan request timeout")
     token = get_test_token()
-    with patch("httpx.AsyncClient.post") as mock_post:
-        mock_post.side_effect = httpx.TimeoutException("Timeout")
-        
-        response = client.post(
-            "/scan",
-            json={
-                "code": "test code",
-                "language": "python"
-            },
-            headers={"Authorization": f"Bearer {token}"}
-        )
-        logger.debug(f"Response status: {response.status_code}")
-        assert response.status_code == 500
-        assert response.json()["detail"] == "AI service unavailable"
+
+    def timeout(request):
+        raise httpx.ReadTimeout("Timeout", request=request)
+
+    upstream.handler = timeout
+    response = client.post(
+        "/scan",
+        json={
+            "code": "test code",
+            "language": "python"
+        },
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    logger.debug(f"Response status: {response.status_code}")
+    assert response.status_code == 500
+    assert response.json()["detail"] == "AI service unavailable"
 
 # 并发测试
-@pytest.mark.asyncio
-async def test_concurrent_requests():
+@pytest.mark.asyncio(scope="session")
+async def test_concurrent_requests(upstream, monkeypatch):
     """测试并发请求"""
     logger.info("Testing concurrent requests")
     token = get_test_token()
-    async def make_request():
-        return client.post(
+    async def make_request(ac):
+        return await ac.post(
             "/scan",
             json={
                 "code": "test code",
@@ -241,65 +475,55 @@ async def test_concurrent_requests():
             },
             headers={"Authorization": f"Bearer {token}"}
         )
-    
-    with patch("httpx.AsyncClient.post") as mock_post:
-        mock_post.return_value = MagicMock(
-            status_code=200,
-            json=lambda: TEST_RESPONSE,
-            raise_for_status=lambda: None
-        )
-        
-        # 创建 10 个并发请求
-        tasks = [make_request() for _ in range(10)]
-        responses = await asyncio.gather(*tasks)
-        
-        # 验证所有请求都成功
-        for i, response in enumerate(responses):
-            logger.debug(f"Response {i+1} status: {response.status_code}")
-            assert response.status_code == 200
-            assert response.json()["status"] == "success"
+
+    # 在本测试的事件循环中运行 lifespan，共享 HTTP 客户端在同一循环中创建和使用，
+    # 不复用 TestClient 在其自身事件循环中创建的状态
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(upstream.dispatch))
+    monkeypatch.setattr(main, "create_http_client", lambda: http_client)
+    monkeypatch.setattr(main, "AI_API_PREWARM", False)
+    monkeypatch.setattr(main.app.state, "http_client", None, raising=False)
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=main.app),
+            base_url="http://test"
+        ) as ac:
+            responses = await asyncio.gather(*(make_request(ac) for _ in range(10)))
+
+    # 验证所有请求都成功
+    for i, response in enumerate(responses):
+        logger.debug(f"Response {i+1} status: {response.status_code}")
+        assert response.status_code == 200
+        assert response.json()["status"] == "success"
+    assert len(upstream.requests) == 10
 
 # 边界条件测试
-def test_scan_with_special_characters():
+def test_scan_with_special_characters(client):
     """测试特殊字符"""
     logger.info("Testing scan request with special characters")
     token = get_test_token()
-    with patch("httpx.AsyncClient.post") as mock_post:
-        mock_post.return_value = MagicMock(
-            status_code=200,
-            json=lambda: TEST_RESPONSE,
-            raise_for_status=lambda: None
-        )
-        
-        response = client.post(
-            "/scan",
-            json={
-                "code": "!@#$%^&*()_+{}[]|\\:;\"'<>,.?/~`",
-                "language": "python"
-            },
-            headers={"Authorization": f"Bearer {token}"}
-        )
-        logger.debug(f"Response status: {response.status_code}")
-        assert response.status_code == 200
+    response = client.post(
+        "/scan",
+        json={
+            "code": "!@#$%^&*()_+{}[]|\\:;\"'<>,.?/~`",
+            "language": "python"
+        },
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    logger.debug(f"Response status: {response.status_code}")
+    assert response.status_code == 200
 
-def test_scan_with_unicode_characters():
+def test_scan_with_unicode_characters(client, upstream):
     """测试 Unicode 字符"""
     logger.info("Testing scan request with Unicode characters")
     token = get_test_token()
-    with patch("httpx.AsyncClient.post") as mock_post:
-        mock_post.return_value = MagicMock(
-            status_code=200,
-            json=lambda: TEST_RESPONSE,
-            raise_for_status=lambda: None
-        )
-        
-        response = client.post(
-            "/scan",
-            json={
-                "code": "你好，世界！",
-                "language": "python"
-            },
-            headers={"Authorization": f"Bearer {token}"}
-        )
-        logger.debug(f"Response status: {response.status_code}")
-        assert response.status_code == 200 
\ No newline at end of file
+    response = client.post(
+        "/scan",
+        json={
+            "code": "你好，世界！",
+            "language": "python"
+        },
+        headers={"Authorization": f"Bearer {token}"}
+    )
+    logger.debug(f"Response status: {response.status_code}")
+    assert response.status_code == 200
+    assert json.loads(upstream.requests[0].content)["code"] == "你好，世界！"